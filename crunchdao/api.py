@@ -1,8 +1,15 @@
 import os
+import copy
+import time
 import logging
-from typing import Dict, List, Optional
+import tempfile
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pandas as pd
 import numpy as np
 import inflection
@@ -11,9 +18,42 @@ from crunchdao import utils
 
 BASE_URL = "https://api.tournament.crunchdao.com"
 
+# seconds API responses are cached for. The latest round can change at any
+# time, the configuration of a given round practically never does.
+CACHE_TTL_LATEST = 60
+CACHE_TTL_ROUND = 3600
+
+# (connect, read) timeouts in seconds. Uploads get more time, the server
+# validates the predictions before it answers.
+TIMEOUT = (3.05, 60)
+UPLOAD_TIMEOUT = (3.05, 300)
+# uploads larger than this many bytes are buffered on disk
+UPLOAD_SPOOL_SIZE = 64 << 20
+
+# maximum number of concurrent API requests
+MAX_WORKERS = 8
+
 
 logger = logging.getLogger(__name__)
 
+# column names come from a small, fixed vocabulary, so the regex based
+# CamelCase to snake_case conversion only needs to run once per name
+_underscore = functools.lru_cache(maxsize=512)(inflection.underscore)
+
+# upload failures that need no further inspection of the response,
+# status code -> (error, hint)
+_UPLOAD_ERRORS: Dict[int, Tuple[str, str]] = {
+    429: ("Too many requests", "Please wait before retrying."),
+    502: ("The server is not available", "Please wait before retrying."),
+    503: ("The server is not available", "Please wait before retrying."),
+    504: ("The server is not available", "Please wait before retrying."),
+}
+
+# pandas >= 2 guesses one timestamp format from the first value and rejects
+# values that differ from it, e.g. with and without fractional seconds.
+# "ISO8601" accepts all of them, older versions infer the format per value.
+_ISO8601 = {"format": "ISO8601"} if int(pd.__version__.split(".")[0]) >= 2 else {}
+
 
 class Client:
     """"Python API for the Crunchdao machine learning tournament"""
@@ -30,6 +70,53 @@ class Client:
         else:
             self.apikey = apikey
 
+        # share one session across all calls, so connections to the
+        # crunchdao servers are pooled and kept alive
+        self.session = requests.Session()
+        # retry transient failures with exponential backoff. Uploads (POST)
+        # are not retried, a retry could create a duplicate submission.
+        retries = Retry(total=5, backoff_factor=0.5,
+                        status_forcelist=[429, 500, 502, 503, 504],
+                        allowed_methods=["HEAD", "GET", "PATCH"],
+                        respect_retry_after_header=True,
+                        raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16,
+                              max_retries=retries)
+        self.session.mount("https://", adapter)
+
+        # cache key -> (timestamp, value)
+        self._cache: Dict[Tuple, Tuple[float, Any]] = {}
+
+    def close(self) -> None:
+        """Close the underlying HTTP session and release its connections"""
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def clear_cache(self) -> None:
+        """Forget all cached API responses
+
+        Use this if you know that something changed on the server, for
+        example after a new round started.
+        """
+        self._cache.clear()
+
+    def _cached(self, key: Tuple, ttl: float, fetch: Callable[[], Any]) -> Any:
+        """Return a copy of `fetch()`, reusing results younger than `ttl`
+        seconds. Copies keep callers from modifying the cached value."""
+        now = time.monotonic()
+        if key in self._cache:
+            timestamp, value = self._cache[key]
+            if now - timestamp < ttl:
+                return copy.deepcopy(value)
+        value = fetch()
+        self._cache[key] = (now, value)
+        return copy.deepcopy(value)
+
     def raw_request(self, url: str, params: Dict = None,
                     authorization: bool = False) -> Dict:
         """Send a raw request to the crunchdao API.
@@ -55,33 +142,55 @@ class Client:
             if self.apikey is None:
                 raise ValueError("api key needed for this request")
             params["apiKey"] = self.apikey
-        response = requests.get(url, params=params)
-        # FIXME add error handling
-        return response.json()
+        # the response gets compressed with every encoding requests can
+        # decode: gzip and deflate, plus br if `brotli` is installed
+        # (`pip install crunchdao[compression]`) and zstd if `zstandard`
+        # is installed as well and urllib3 is 2.0 or newer
+        response = self.session.get(url, params=params,
+                                    headers={"Accept": "application/json"},
+                                    timeout=TIMEOUT)
+        try:
+            response.raise_for_status()
+        except requests.HTTPError as error:
+            raise ValueError(f"request failed with status "
+                             f"{response.status_code}: {response.text}") \
+                from error
+        return utils.parse_json(response)
 
     def download_data(self, directory: str = ".",
-                      file_format: str = "csv") -> List[str]:
+                      file_format: str = "parquet") -> List[str]:
         """Download training data, targets, test data and a submission example
 
         Args:
             directory (str): directory where the files are downloaded to
-            file_format (str): `csv` or 'parquet`
+            file_format (str): `parquet` (default) or `csv`. Parquet files
+                are much smaller and faster to load, reading them with pandas
+                requires `pyarrow`.
 
         Returns:
-            list[str]: Paths to the three files
+            list[str]: Paths to the four files
 
         Example:
             >>> client = crunchdao.Client()
             >>> client.download_data()
+            ['./X_train.parquet', './y_train.parquet', './X_test.parquet',
+             './example_submission.parquet']
+            >>> client.download_data(file_format="csv")
             ['./X_train.csv', './y_train.csv', './X_test.csv', './example_submission.csv']
         """
         assert file_format in {"csv", "parquet"}, "unknown file format"
-        paths = []
-        for dataset in ["X_train", "y_train", "X_test", "example_submission"]:
-            filename = f"{dataset}.{file_format}"
-            url = f'https://tournament.crunchdao.com/data/{filename}'
-            path = utils.download_file(url, os.path.join(directory, filename))
-            paths.append(path)
+        datasets = ["X_train", "y_train", "X_test", "example_submission"]
+        # the downloads are independent of each other, so fetch them all
+        # at once instead of one after the other
+        with ThreadPoolExecutor(max_workers=len(datasets)) as executor:
+            futures = []
+            for dataset in datasets:
+                filename = f"{dataset}.{file_format}"
+                url = f'https://tournament.crunchdao.com/data/{filename}'
+                futures.append(executor.submit(
+                    utils.download_file, url,
+                    os.path.join(directory, filename), session=self.session))
+            paths = [future.result() for future in futures]
         return paths
 
     def set_comment(self, submission_id: int, comment: str) -> None:
@@ -97,21 +206,27 @@ class Client:
             >>> client.set_comment(submission_id, "bla bla")
             Comment set.
         """
-        response = requests.patch(
+        response = self.session.patch(
             f"{BASE_URL}/v2/submissions/{submission_id}",
             json={"comment": comment},
-            params={"apiKey": self.apikey})
+            params={"apiKey": self.apikey},
+            timeout=TIMEOUT)
         if response.status_code == 200:
             logger.info("Comment set.")
         else:
             logger.error("setting comment failed")
             logger.error(response.content)
 
-    def upload(self, predictions: pd.DataFrame) -> Optional[int]:
+    def upload(self, predictions: pd.DataFrame,
+               file_format: str = "csv") -> Optional[int]:
         """Upload predictions to the tournament
 
         Args:
             predictions (pd.DataFrame): dataframe with your predictions
+            file_format (str): `csv` (default), `parquet` or `feather`. The
+                binary formats are much faster to write and require `pyarrow`
+                (`pip install crunchdao[parquet]`). They only work if the
+                tournament server accepts them, `csv` is always supported.
 
         Returns:
             int: ID of the submission
@@ -120,29 +235,60 @@ class Client:
             >>> client = crunchdao.Client()
             >>> predictions = .... # pd.DataFrame containing your predictions
             >>> client.upload(predictions)
+            >>> client.upload(predictions, file_format="parquet")
         """
-        response = requests.post(
-            BASE_URL + "/v2/submissions",
-            params={"apiKey": self.apikey},
-            files={"file": ("x", predictions.to_csv(index=False).encode('ascii'))},
-        )
+        assert file_format in {"csv", "parquet", "feather"}, \
+            "unknown file format"
+        # large files are spooled to disk instead of being held in memory
+        # in addition to the request body requests builds from them
+        with tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_SIZE) as buffer:
+            if file_format == "parquet":
+                predictions.to_parquet(buffer, index=False, compression="zstd")
+                filename = "x.parquet"
+                content_type = "application/vnd.apache.parquet"
+            elif file_format == "feather":
+                predictions.reset_index(drop=True).to_feather(
+                    buffer, compression="lz4")
+                filename = "x.feather"
+                content_type = "application/vnd.apache.arrow.file"
+            else:
+                # let pandas write the encoded csv straight into a binary
+                # buffer, instead of building a str and encoding it afterwards
+                predictions.to_csv(buffer, index=False, encoding="ascii")
+                filename = "x"
+                content_type = None
+            buffer.seek(0)
+            response = self.session.post(
+                BASE_URL + "/v2/submissions",
+                params={"apiKey": self.apikey},
+                files={"file": (filename, buffer, content_type)},
+                timeout=UPLOAD_TIMEOUT,
+            )
 
         if response.status_code == 200:
             logger.info("Submission submitted :)")
-            submission_id = response.json()["id"]
-            return submission_id
-        elif response.status_code == 502:
-            logger.error("The server is not available")
-            logger.info("Please wait before retrying.")
+            return utils.parse_json(response)["id"]
+
+        if response.status_code in _UPLOAD_ERRORS:
+            error, hint = _UPLOAD_ERRORS[response.status_code]
+            logger.error(error)
+            logger.info(hint)
+            return None
+
+        # only parse the body if it is json, error pages from proxies or
+        # load balancers are usually html
+        content_type = response.headers.get("Content-Type", "")
+        if "json" not in content_type:
+            logger.error(response.text)
+            return None
+        body = utils.parse_json(response)
+        if "message" in body:
+            logger.error(body["message"])
+        elif "code" in body:
+            logger.error(body["code"])
         else:
-            body = response.json()
-
-            if "message" in body:
-                logger.error(body["message"])
-            elif "code" in body:
-                logger.error(body["code"])
-            else:
-                logger.error(str(body))
+            logger.error(str(body))
+        return None
 
     def submissions(self, user_id: int = None,
                     round_num: int = None) -> pd.DataFrame:
@@ -184,28 +330,64 @@ class Client:
             params["round"] = round_num
         data = self.raw_request(url, params, authorization=authorization)
 
-        user = pd.DataFrame([item["user"] for item in data])
-        user.rename(columns={"id": "user_id"}, inplace=True)
-
-        file_meta = pd.DataFrame([item["fileMetadata"] for item in data])
-        columns = {col: "file_" + col for col in file_meta}
-        file_meta.rename(columns=columns, inplace=True)
-
-        general = pd.DataFrame.from_dict(data)
-        general.rename(columns={"uploadedAt": "upload_ts",
-                                "evaluatedAt": "eval_ts"}, inplace=True)
-        general.drop(["user", "userId", "fileMetadata"],
-                     axis=1, inplace=True, errors="ignore")
-        df = pd.concat([user, general, file_meta], axis=1)
+        # flatten the nested `user` and `fileMetadata` dicts into one row per
+        # submission, with the final column names
+        columns = {"uploadedAt": "upload_ts", "evaluatedAt": "eval_ts"}
+        rows = []
+        for item in data:
+            row = {("user_id" if key == "id" else key): val
+                   for key, val in item["user"].items()}
+            row.update((columns.get(key, key), val) for key, val in item.items()
+                       if key not in ("user", "userId", "fileMetadata"))
+            row.update(("file_" + key, val)
+                       for key, val in item["fileMetadata"].items())
+            rows.append(row)
+        df = pd.DataFrame(rows)
         df.set_index("id", inplace=True)
+        # parse timestamps once per column, instead of leaving them as
+        # object columns of strings
+        for col in ["upload_ts", "eval_ts"]:
+            if col in df:
+                df[col] = pd.to_datetime(df[col], utc=True, **_ISO8601)
 
         # convert CamelCase to snake_case
-        df.columns = [inflection.underscore(col) for col in df.columns]
+        df.columns = [_underscore(col) for col in df.columns]
         return df
 
+    def submissions_bulk(self, user_ids: List[int],
+                         round_num: int = None) -> pd.DataFrame:
+        """Get the submissions of several users at once.
+
+        The requests are sent concurrently, which is much faster than
+        calling `submissions` for one user after the other.
+
+        Args:
+            user_ids (list[int]): selected user_ids
+            round_num (int): allows to spefify a single round, defaults to all
+                             rounds
+
+        Returns:
+            pd.DataFrame: submissions information of all selected users, with
+                the same columns as returned by `submissions`. Empty if no
+                user_ids are given.
+
+        Example:
+            >>> crunchdao.Client().submissions_bulk([42, 43], round_num=89)
+        """
+        if not user_ids:
+            return pd.DataFrame()
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            frames = list(executor.map(
+                lambda user_id: self.submissions(user_id, round_num),
+                user_ids))
+        return pd.concat(frames)
+
     def dataset_config(self, round_num: int = None) -> Dict:
         """Get the dataset configuration for some round
 
+        Results are cached for `CACHE_TTL_LATEST` seconds for the latest
+        round and `CACHE_TTL_ROUND` seconds otherwise, see `clear_cache`.
+
         Args:
             round_num (int): allows to spefify a single round, defaults to the
                              latest round
@@ -238,21 +420,29 @@ class Client:
         """
         if round_num is None:
             round_num = "@latest"
+            ttl = CACHE_TTL_LATEST
+        else:
+            ttl = CACHE_TTL_ROUND
         url = f"{BASE_URL}/v2/rounds/{round_num}/dataset-config"
-        data = self.raw_request(url)
-        data["dataset_id"] = data["dataset"]["id"]
-        data["dataset_name"] = data["dataset"]["name"]
 
-        for item in ["id", "dataset"]:
-            del data[item]
+        def fetch():
+            data = self.raw_request(url)
+            data["dataset_id"] = data["dataset"]["id"]
+            data["dataset_name"] = data["dataset"]["name"]
 
-        cleaned = {inflection.underscore(key): val
-                   for key, val in data.items()}
-        return cleaned
+            for item in ["id", "dataset"]:
+                del data[item]
+
+            return {_underscore(key): val for key, val in data.items()}
+
+        return self._cached(("dataset_config", round_num), ttl, fetch)
 
     def get_scores(self, user_id: int = None, resolved_scores: bool=True) -> pd.DataFrame:
         """Get the scores for the given dataset
 
+        The list of rounds is cached for `CACHE_TTL_LATEST` seconds, see
+        `clear_cache`.
+
         Args:
             user_id (int, optional): selected user_id, defaults to your own
             resolved_scores: (boolean): return only resolved scores, default to True
@@ -279,65 +469,85 @@ class Client:
 
         # Get dataset rounds information
         url=f'{BASE_URL}/v2/datasets/11/rounds'
-        data = self.raw_request(url, authorization=authorization)
-        dataset_rounds_dict = {}
-        for round_iter in data:
-            inception_date = pd.to_datetime(round_iter['inception'])
-            if pd.isnull(inception_date):
-                continue
-            scoring_start = inception_date
-            i = 0
-            # The scoring starts 2 trading days after the inception date
-            while scoring_start < inception_date + pd.Timedelta(days=7) and i < 2:
-                if utils.is_trading_day(scoring_start):
-                    i += 1
-                scoring_start += pd.Timedelta(days=1)
-            dataset_rounds_dict[round_iter['id']] = {
-                'inception': inception_date,
-                'scoring_start': scoring_start
-            }
-
-        # Get dataset scores
-        scores = pd.DataFrame()
-        for round_id, info in dataset_rounds_dict.items():
-            params = {"roundId": round_id}
-            url = f"{BASE_URL}/v2/scores"
-            data = self.raw_request(url, params=params, authorization=authorization)
+        data = self._cached(
+            ("dataset_rounds", 11, authorization), CACHE_TTL_LATEST,
+            lambda: self.raw_request(url, authorization=authorization))
+        inception = pd.Series({
+            round_iter['id']: pd.to_datetime(round_iter['inception'])
+            for round_iter in data}).dropna()
+        inception_day = inception.dt.normalize()
+        # The scoring starts the day after the 2nd trading day, counting from
+        # the inception date, but at most 7 days after the inception date
+        calendar = utils.trading_days(
+            inception_day.min(), inception_day.max() + pd.Timedelta(days=7))
+        first_trading_day = np.searchsorted(
+            calendar, inception_day.values.astype('datetime64[D]'))
+        second_trading_day = calendar[first_trading_day + 1]
+        delay = np.minimum(
+            second_trading_day - inception_day.values + np.timedelta64(1, 'D'),
+            np.timedelta64(7, 'D'))
+        scoring_start = inception + delay
+
+        # Get dataset scores, one request per round. The requests are
+        # independent of each other, so send them concurrently.
+        url = f"{BASE_URL}/v2/scores"
+
+        def fetch_scores(round_id):
+            return self.raw_request(url, params={"roundId": round_id},
+                                    authorization=authorization)
+
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            rounds_scores = list(executor.map(fetch_scores,
+                                              scoring_start.index))
+
+        # collect plain arrays and only build the DataFrame at the very end
+        round_ids, dates, values = [], [], []
+        for round_id, data in zip(scoring_start.index, rounds_scores):
             for day in data:
-                scores.loc[day['crunch']['date'], round_id] = day['value']
-        scores = scores.stack().reset_index().rename({
-            'level_0':'scoring_date',
-            'level_1':'round_id',
-            0:'score'}, axis=1)
-
-        for round_id, info in dataset_rounds_dict.items():
-            scores.loc[scores['round_id'] == round_id, 'scoring_start'] = info['scoring_start']
-
-        # Get associated target
-        scores['scoring_date'] = pd.to_datetime(scores['scoring_date'])
-        scores['time_delta'] = (scores['scoring_date']
-            - scores['scoring_start']).dt.days + 1 # +1: Include first day
-        scores['target'] = np.nan
+                round_ids.append(round_id)
+                dates.append(day['crunch']['date'])
+                values.append(day['value'])
+        round_ids = np.asarray(round_ids)
+        dates = pd.to_datetime(dates, format='%Y-%m-%d').values
+        values = np.asarray(values, dtype=np.float64)
+        starts = scoring_start.loc[round_ids].values
+        # +1: Include first day
+        time_delta = (dates - starts) // np.timedelta64(1, 'D') + 1
+
+        # Get associated target: each score belongs to the shortest target
+        # whose horizon covers it, scores beyond the longest horizon are
+        # dropped
         targets_dict = {'target_w': 7, 'target_r': 30, 'target_g': 60, 'target_b': 90}
-        for target, horizon in targets_dict.items():
-            scores.loc[(scores.time_delta <= horizon) & (~scores.target.notna()), 'target'] = target
-
-        # Get last scoring date for each target
-        def get_target_end_date(grp):
-            target = grp.iloc[0]['target']
-            target_end_date = (grp.scoring_start.iloc[0]
-                + pd.Timedelta(days=targets_dict[target] - 1))
-            while not utils.is_trading_day(target_end_date):
-                target_end_date -= pd.Timedelta(days=1)
-            grp.loc[:, 'scoring_end'] = target_end_date
-            return grp
-        scores = scores \
-            .groupby(['round_id', 'target'], group_keys=False) \
-            .apply(lambda grp: get_target_end_date(grp))
-
-        # Add resolved targets filter
-        scores['is_resolved'] = scores.scoring_date == scores.scoring_end
-        scores = scores.sort_values(by=['round_id', 'scoring_date'])
+        horizons = np.array(list(targets_dict.values()))
+        target_idx = np.searchsorted(horizons, time_delta)
+        keep = target_idx < len(horizons)
+        round_ids, dates, values, starts, time_delta, target_idx = (
+            round_ids[keep], dates[keep], values[keep], starts[keep],
+            time_delta[keep], target_idx[keep])
+
+        # Get last scoring date for each target: the last trading day on or
+        # before the end of the target's horizon
+        target_end = starts + (horizons[target_idx] - 1).astype('timedelta64[D]')
+        target_end_day = target_end.astype('datetime64[D]')
+        # holidays and weekends never add up to more than a few days
+        calendar = utils.trading_days(
+            target_end_day.min() - np.timedelta64(10, 'D'), target_end_day.max())
+        last_trading_day = calendar[np.searchsorted(
+            calendar, target_end_day, side='right') - 1]
+        scoring_end = target_end - (target_end_day - last_trading_day)
+
+        order = np.lexsort((dates, round_ids))
+        scores = pd.DataFrame({
+            'scoring_date': dates[order],
+            'round_id': round_ids[order],
+            'score': values[order],
+            'scoring_start': starts[order],
+            'time_delta': time_delta[order],
+            'target': np.array(list(targets_dict), dtype=object)[target_idx[order]],
+            'scoring_end': scoring_end[order],
+            # Add resolved targets filter
+            'is_resolved': dates[order] == scoring_end[order],
+        })
 
         if resolved_scores:
             return scores[scores['is_resolved']]
@@ -1,33 +1,80 @@
 import os
+import shutil
 import logging
+import functools
+from typing import Any, Optional
 
 import tqdm
 import requests
+import numpy as np
 import pandas as pd
 import holidays
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 logger = logging.getLogger(__name__)
 
+# (connect, read) timeout in seconds for data downloads
+DOWNLOAD_TIMEOUT = (5, 300)
+# size of the blocks written to disk during downloads
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+# range of the precomputed trading day calendar, dates outside of it are
+# still supported but slower to look up
+CALENDAR_START = "2015-01-01"
+CALENDAR_END = "2035-12-31"
+
+
+def parse_json(response: requests.Response) -> Any:
+    """decode the json body of a response, using `orjson` if installed"""
+    if orjson is None:
+        return response.json()
+    return orjson.loads(response.content)  # pylint: disable=no-member
+
 
 def download_file(url: str, dest_path: str,
-                  show_progress_bars: bool = True) -> str:
-    """downloads a file and shows a progress bar. allows resuming a download"""
-    file_size = 0
-    req = requests.get(url, stream=True)
-    req.raise_for_status()
+                  show_progress_bars: bool = True,
+                  session: Optional[requests.Session] = None) -> str:
+    """downloads a file and shows a progress bar. allows resuming a download
 
-    # Total size in bytes.
-    total_size = int(req.headers.get('content-length', 0))
+    The server's ETag of the uncompressed file is stored next to it
+    (`<dest_path>.etag`), to detect files that changed on the server since
+    they were downloaded. Files that were transferred compressed have no
+    stored ETag and are only checked by size.
+
+    Pass a `requests.Session` to reuse its pooled connections."""
+    http = requests if session is None else session
+    etag_path = dest_path + ".etag"
+    file_size = 0
+    headers = {}
 
     if os.path.exists(dest_path):
         logger.info("target file already exists")
+        # only ask for the size and version, the file might not need
+        # downloading at all. Sizes and byte ranges have to refer to the
+        # uncompressed file.
+        head = http.head(url, headers={'Accept-Encoding': 'identity'},
+                         allow_redirects=True, timeout=DOWNLOAD_TIMEOUT)
+        head.raise_for_status()
+        # Total size in bytes.
+        total_size = int(head.headers.get('content-length', 0))
         file_size = os.stat(dest_path).st_size  # File size in bytes
-        if file_size < total_size:
+        etag = _read_etag(etag_path)
+        if etag and not _same_etag(etag, head.headers.get('ETag')):
+            # Outdated file, restart download
+            logger.info("file changed on the server, restarting download")
+            os.remove(dest_path)
+            file_size = 0
+        elif file_size < total_size:
             # Download incomplete
             logger.info("resuming download")
-            resume_header = {'Range': f'bytes={file_size}-'}
-            req = requests.get(url, headers=resume_header, stream=True,
-                               verify=False, allow_redirects=True)
+            headers = {'Range': f'bytes={file_size}-',
+                       'Accept-Encoding': 'identity'}
+            if etag and not etag.startswith('W/'):
+                # get the whole file if it changes in the meantime
+                headers['If-Range'] = etag
         elif file_size == total_size:
             # Download complete
             logger.info("download complete")
@@ -41,20 +88,92 @@ def download_file(url: str, dest_path: str,
         # File does not exist, starting download
         logger.info("starting download")
 
-    # write dataset to file and show progress bar
-    pbar = tqdm.tqdm(total=total_size, unit='B', unit_scale=True,
-                     desc=dest_path, disable=not show_progress_bars)
-    # Update progress bar to reflect how much of the file is already downloaded
-    pbar.update(file_size)
-    with open(dest_path, "ab") as dest_file:
-        for chunk in req.iter_content(1024):
-            dest_file.write(chunk)
-            pbar.update(1024)
+    req = http.get(url, headers=headers, stream=True,
+                   timeout=DOWNLOAD_TIMEOUT)
+    req.raise_for_status()
+    if file_size and req.status_code != 206:
+        # server ignored the range request and sends the whole file
+        logger.info("resuming not supported, restarting download")
+        os.remove(dest_path)
+        file_size = 0
+    if 'content-encoding' in req.headers:
+        # fresh downloads may be compressed in transit (gzip, deflate and,
+        # if supported, br and zstd). The content-length then is the
+        # compressed size, which says little about the file size.
+        total_size = None
+        # the ETag belongs to the compressed representation, it would never
+        # match the one of the uncompressed file checked above
+        _write_etag(etag_path, None)
+    else:
+        total_size = file_size + int(req.headers.get('content-length', 0))
+        _write_etag(etag_path, req.headers.get('ETag'))
+
+    # write dataset to file and show progress bar. Copying from the raw
+    # stream in large blocks keeps the per-chunk python overhead low.
+    with req, open(dest_path, "ab") as dest_file, \
+            tqdm.tqdm.wrapattr(dest_file, "write", total=total_size,
+                               initial=file_size, desc=dest_path,
+                               disable=not show_progress_bars) as dest:
+        req.raw.decode_content = True
+        shutil.copyfileobj(req.raw, dest, DOWNLOAD_CHUNK_SIZE)
     return dest_path
 
+
+def _read_etag(path: str) -> Optional[str]:
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="ascii") as etag_file:
+        return etag_file.read().strip() or None
+
+
+def _write_etag(path: str, etag: Optional[str]) -> None:
+    if etag:
+        with open(path, "w", encoding="ascii") as etag_file:
+            etag_file.write(etag)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def _same_etag(first: str, second: Optional[str]) -> bool:
+    """weak comparison, servers often mark the ETags of compressed
+    responses as weak (`W/"..."`)"""
+    if second is None:
+        return False
+    return first.replace('W/', '', 1) == second.replace('W/', '', 1)
+
 def is_trading_day(date: pd.Timestamp) -> bool:
     """Tells if a given date is a trading day"""
-    us_holidays = holidays.NYSE()
-    is_bday = bool(len(pd.bdate_range(date, date)))
-    is_not_holiday = date not in us_holidays
-    return is_bday and is_not_holiday
+    day = np.datetime64(pd.Timestamp(date).date(), "D")
+    calendar = _trading_day_calendar()
+    if not calendar[0] <= day <= calendar[-1]:
+        return len(_compute_trading_days(date, date)) > 0
+    return calendar[np.searchsorted(calendar, day)] == day
+
+
+def trading_days(start: pd.Timestamp, end: pd.Timestamp) -> np.ndarray:
+    """Sorted array of all trading days between `start` and `end` (inclusive)
+
+    Useful to look up many dates at once with `np.searchsorted`."""
+    first = np.datetime64(pd.Timestamp(start).date(), "D")
+    last = np.datetime64(pd.Timestamp(end).date(), "D")
+    calendar = _trading_day_calendar()
+    if first < calendar[0] or last > calendar[-1]:
+        return _compute_trading_days(start, end)
+    return calendar[np.searchsorted(calendar, first):
+                    np.searchsorted(calendar, last, side="right")]
+
+
+@functools.lru_cache(maxsize=None)
+def _trading_day_calendar() -> np.ndarray:
+    """All trading days between `CALENDAR_START` and `CALENDAR_END`, built
+    on first use and shared by all lookups afterwards"""
+    return _compute_trading_days(CALENDAR_START, CALENDAR_END)
+
+
+def _compute_trading_days(start: pd.Timestamp,
+                          end: pd.Timestamp) -> np.ndarray:
+    days = pd.bdate_range(start, end)
+    us_holidays = holidays.NYSE(years=range(pd.Timestamp(start).year,
+                                            pd.Timestamp(end).year + 1))
+    is_holiday = days.isin(pd.to_datetime(list(us_holidays)))
+    return days[~is_holiday].values.astype("datetime64[D]")